@@ -1,5 +1,6 @@
 # Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
 # Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+import os
 from datetime import timedelta
 from typing import NamedTuple
 
@@ -13,7 +14,16 @@ class Table(NamedTuple):
         return f'"{self.database}"."{self.schema}"."{self.name}"'
 
 MAX_RECORDS_PER_CALL = 3000
+MAX_CONCURRENT_SENDS = max(1, int(os.environ.get('TELEMETRY_MAX_CONCURRENT_SENDS', 4)))
+SEND_QUEUE_SIZE = MAX_CONCURRENT_SENDS
+MAX_SEND_RETRIES = 3
+MAX_RETRY_DELAY_S = 30
+SEND_TIMEOUT_S = 30
+SOCKET_SEND_BUFFER_SIZE = max(0, int(os.environ.get('TELEMETRY_SOCKET_SEND_BUFFER', 0)))
+GZIP_LEVEL = 1
+GZIP_MIN_SIZE = 1024
 TELEMETRY_URL = 'https://api.cloudzero.com/unit-cost/v1/telemetry'
+USER_AGENT = 'CloudZero-Snowflake-Telemetry/1.0'
 TELEMETRY_SECRETS_ID = 'cloudzero_telemetry_secrets'
 STREAM_NAME = 'query-execution-time'
 QUERY_EXECUTION_TIME_TELEMETRY_VIEW = Table(
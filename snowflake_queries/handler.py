@@ -1,31 +1,57 @@
 # Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
 # Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+import gzip
 import logging
+import os
+import random
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime, timedelta
 from enum import Enum
-from typing import NamedTuple, Dict, List
+from functools import lru_cache
+from queue import Queue
+from threading import Event, Lock
+from typing import NamedTuple, Dict, List, Iterator, Optional, TYPE_CHECKING
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 from dateutil.tz import tzutc
-from snowflake.connector import SnowflakeConnection
-from toolz import partition_all, keymap
+from toolz import partition_all
 
 from constants import TELEMETRY_SECRETS_ID, TELEMETRY_URL, Table, MAX_RECORDS_PER_CALL, SNOWFLAKE_SECRETS_ID, \
-    DEFAULT_WAREHOUSE, DATA_LATENCY, STREAM_NAME, QUERY_EXECUTION_TIME_TELEMETRY_VIEW
+    DEFAULT_WAREHOUSE, DATA_LATENCY, STREAM_NAME, QUERY_EXECUTION_TIME_TELEMETRY_VIEW, SEND_QUEUE_SIZE, \
+    GZIP_LEVEL, GZIP_MIN_SIZE, MAX_CONCURRENT_SENDS, MAX_SEND_RETRIES, MAX_RETRY_DELAY_S, \
+    USER_AGENT, SOCKET_SEND_BUFFER_SIZE, SEND_TIMEOUT_S
 from util import aws, snowflake, json
-from util.json import serializable
+
+if TYPE_CHECKING:
+    from snowflake.connector import SnowflakeConnection
 
 logger = logging.getLogger('snowflake-queries-telemetry')
 
+_END_OF_RECORDS = None
+_GZIP_HEADERS = {'Content-Encoding': 'gzip'}
+_connect_lock = Lock()
+# Only statuses where the API itself turned the request away; a gateway 502/504 can arrive after the
+# records were already stored, and retrying those would send them twice
+_RETRY_STATUSES = frozenset([429, 503])
+_AUTH_FAILURE_STATUSES = frozenset([401, 403])
+
 
 class UnitCostGranularity(Enum):
     hourly = 'hourly'
     daily = 'daily'
 
 
+_HOURLY = UnitCostGranularity.hourly
+
+
 class TelemetryApiConnection(NamedTuple):
     url: str
-    api_key: str
+    session: requests.Session
 
 
 class DateRange(NamedTuple):
@@ -42,63 +68,184 @@ class TelemetryRecord(NamedTuple):
     timestamp: datetime
 
 
+class _TelemetryAdapter(HTTPAdapter):
+    # Only sets SO_SNDBUF when configured: on Linux a fixed size disables send buffer autotuning and is
+    # capped at net.core.wmem_max, so it can lower throughput.  Keeps urllib3's TCP_NODELAY default.
+    def init_poolmanager(self, *args, **kwargs):
+        if SOCKET_SEND_BUFFER_SIZE:
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SEND_BUFFER_SIZE)
+            ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+@lru_cache(maxsize=None)
 def _connect_api() -> TelemetryApiConnection:
     external_api_key = aws.get_secrets(TELEMETRY_SECRETS_ID)['external_api_key']
-    return TelemetryApiConnection(url=TELEMETRY_URL, api_key=external_api_key)
+    # One keep-alive session for every POST so batches after the first skip the TCP/TLS handshake
+    session = requests.Session()
+    session.headers.update({
+        'Authorization': external_api_key,
+        'Content-Type': 'application/json',
+        'User-Agent': USER_AGENT
+    })
+    # Every sender thread gets its own pooled connection to the single telemetry host.  The adapter only
+    # retries failed connections; retryable responses are handled in _send_telemetry_records.
+    session.mount('https://', _TelemetryAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_SENDS,
+                                                max_retries=MAX_SEND_RETRIES))
+    return TelemetryApiConnection(url=TELEMETRY_URL, session=session)
+
+
+def _forget_api_connection_after_fork():
+    # A forked child must not share the parent's pooled TLS sockets
+    global _connect_lock
+    _connect_lock = Lock()
+    _connect_api.cache_clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_api_connection_after_fork)
+
+
+def _retry_delay(response: requests.Response, attempt: int) -> Optional[float]:
+    # Jittered so that concurrent senders that were throttled together don't all retry at the same moment.
+    # None means the server asked for more seconds than we are willing to wait, so give up instead.  A
+    # Retry-After we don't parse (e.g. an HTTP date) falls back to the exponential backoff.
+    retry_after = (response.headers.get('Retry-After') or '').strip()
+    # isdigit() alone also accepts non-ASCII digits such as '\xb2', which int() rejects
+    if not (retry_after.isascii() and retry_after.isdigit()):
+        return min(MAX_RETRY_DELAY_S, 2 ** attempt + random.random())
+    if int(retry_after) > MAX_RETRY_DELAY_S:
+        return None
+    return min(MAX_RETRY_DELAY_S, int(retry_after) + random.random())
+
+
+def _encode_records(records: List[TelemetryRecord]) -> bytes:
+    # Encoded in a single orjson call, which also handles the granularity enum and timestamps natively
+    return json.dumpb({
+        'records': [{
+            'granularity': record.granularity,
+            'element-name': record.element_name,
+            'filter': record.filter,
+            'telemetry-stream': record.telemetry_stream,
+            'value': record.value,
+            'timestamp': record.timestamp
+        } for record in records]
+    })
 
 
 def _send_telemetry_records(conn: TelemetryApiConnection, records: List[TelemetryRecord]):
-    logger.debug(f'Sending telemetry to {conn.url}')
-    response = requests.post(
-        conn.url,
-        headers={
-            'Authorization': conn.api_key
-        },
-        json={
-            'records': [keymap(lambda k: k.replace('_', '-'), x) for x in serializable(records)]
-        })
+    started = time.monotonic()
+    payload = _encode_records(records)
+    headers = None
+    if len(payload) >= GZIP_MIN_SIZE:
+        payload = gzip.compress(payload, compresslevel=GZIP_LEVEL)
+        headers = _GZIP_HEADERS
+    for attempt in range(MAX_SEND_RETRIES + 1):
+        response = conn.session.post(conn.url, headers=headers, data=payload, timeout=SEND_TIMEOUT_S)
+        if response.status_code not in _RETRY_STATUSES or attempt == MAX_SEND_RETRIES:
+            break
+        delay = _retry_delay(response, attempt)
+        if delay is None:
+            logger.warning('Got %d sending telemetry to %s with Retry-After %r, not retrying',
+                           response.status_code, conn.url, response.headers.get('Retry-After'))
+            break
+        logger.warning('Got %d sending telemetry to %s, retrying in %.1fs', response.status_code, conn.url, delay)
+        time.sleep(delay)
+
     if not response.ok:
-        logger.error(f'Got {response.status_code} sending telemetry to {conn.url}')
-        logger.error(response.text)
+        logger.error('Got %d sending telemetry to %s: %s', response.status_code, conn.url, response.text)
+        if response.status_code in _AUTH_FAILURE_STATUSES:
+            # The API key may have been rotated; reconnect with a freshly fetched key on the next run
+            aws.invalidate_secrets(TELEMETRY_SECRETS_ID)
+            _connect_api.cache_clear()
+            # The dropped session would otherwise keep its pooled sockets open in a warm process
+            conn.session.close()
         response.raise_for_status()
+    logger.debug('Sent %d telemetry records (%d bytes) to %s in %.2fs',
+                 len(records), len(payload), conn.url, time.monotonic() - started)
 
 
-def _collect_records_from_view(conn: SnowflakeConnection, date_range: DateRange,
-                               stream_name: str, view: Table) -> List[TelemetryRecord]:
+def _collect_records_from_view(conn: 'SnowflakeConnection', date_range: DateRange,
+                               stream_name: str, view: Table) -> Iterator[TelemetryRecord]:
     sql = f"""
-        SELECT element_name, timestamp, filter, value
+        SELECT element_name, timestamp, filter, value::FLOAT AS value
         FROM {view}
-        WHERE timestamp >= '{date_range.start.isoformat()}' AND
-              timestamp < '{date_range.end.isoformat()}'
+        WHERE timestamp >= %s AND
+              timestamp < %s AND
+              element_name IS NOT NULL AND
+              value IS NOT NULL
         """
-    result = snowflake.execute(conn, sql)
-
-    return [TelemetryRecord(
-        granularity=UnitCostGranularity.hourly,
-        element_name=x['element_name'],
-        timestamp=x['timestamp'],
-        filter=json.loads(x['filter']),
-        telemetry_stream=stream_name,
-        value=x['value']
-    ) for x in result]
+    params = [date_range.start.isoformat(), date_range.end.isoformat()]
+
+    # Columns are converted from Arrow one at a time and zipped back into records, which is much
+    # cheaper than converting row by row. The records are built positionally (TelemetryRecord field order).
+    record, loads = TelemetryRecord, json.loads
+    # There is one filter per warehouse, so each distinct filter is parsed once and shared by its records
+    filters: Dict[str, Dict[str, List[str]]] = {}
+    with closing(snowflake.execute_columns(conn, sql, params=params)) as batches:
+        for batch in batches:
+            for element_name, raw_filter, value, timestamp in zip(batch['element_name'], batch['filter'],
+                                                                   batch['value'], batch['timestamp']):
+                row_filter = filters.get(raw_filter)
+                if row_filter is None:
+                    row_filter = loads(raw_filter) if raw_filter and raw_filter != '{}' else {}
+                    filters[raw_filter] = row_filter
+                yield record(_HOURLY, element_name, row_filter, stream_name, value, timestamp)
+
+
+def _send_record_groups(record_groups: Queue, stop: Event):
+    conn = None
+    error = None
+    while True:
+        record_group = record_groups.get()
+        if record_group is _END_OF_RECORDS:
+            break
+        if stop.is_set():
+            # A send has failed; keep draining so the producer never blocks on a full queue
+            continue
+        try:
+            if conn is None:
+                # Connecting fetches the API key, so it waits until there is something to send
+                with _connect_lock:
+                    conn = _connect_api()
+            _send_telemetry_records(conn, record_group)
+        except BaseException as e:
+            error = e
+            stop.set()
+    if error is not None:
+        raise error
 
 
 def send_data_from_view(date_range: DateRange, stream: str, view: Table):
-    api_conn = _connect_api()
-    snow_conn = snowflake.connect(SNOWFLAKE_SECRETS_ID, DEFAULT_WAREHOUSE)
-
-    records = _collect_records_from_view(snow_conn, date_range, stream, view)
-    for record_group in partition_all(MAX_RECORDS_PER_CALL, records):
-        if record_group:
-            _send_telemetry_records(api_conn, record_group)
+    record_groups = Queue(maxsize=SEND_QUEUE_SIZE)
+    stop = Event()
+
+    # Records are fetched from Snowflake on this thread while a pool of senders posts them to the API
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_SENDS) as executor:
+        senders = [executor.submit(_send_record_groups, record_groups, stop)
+                   for _ in range(MAX_CONCURRENT_SENDS)]
+        try:
+            with snowflake.connection(SNOWFLAKE_SECRETS_ID, DEFAULT_WAREHOUSE) as snow_conn, \
+                    closing(_collect_records_from_view(snow_conn, date_range, stream, view)) as records:
+                # closing() shuts the cursor before the connection goes back to the pool, even on an early stop
+                for record_group in partition_all(MAX_RECORDS_PER_CALL, records):
+                    if stop.is_set():
+                        break
+                    record_groups.put(record_group)
+        finally:
+            for _ in senders:
+                record_groups.put(_END_OF_RECORDS)
+        for sender in senders:
+            sender.result()
 
 
 if __name__ == '__main__':
     current_hour = datetime.now(tz=tzutc()).replace(minute=0, second=0, microsecond=0)
     start = current_hour - DATA_LATENCY - timedelta(hours=1)
-    range = DateRange(
+    date_range = DateRange(
         start=start,
         end=start + timedelta(hours=1)
     )
 
-    send_data_from_view(range, STREAM_NAME, QUERY_EXECUTION_TIME_TELEMETRY_VIEW)
\ No newline at end of file
+    send_data_from_view(date_range, STREAM_NAME, QUERY_EXECUTION_TIME_TELEMETRY_VIEW)
\ No newline at end of file
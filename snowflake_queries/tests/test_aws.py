@@ -0,0 +1,58 @@
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from util import aws
+
+
+class FakeSecretsManager:
+    def __init__(self):
+        self.lookups = 0
+
+    def get_secret_value(self, SecretId):
+        self.lookups += 1
+        return {'SecretString': json.dumps({'password': f'{SecretId}-{self.lookups}'})}
+
+
+@pytest.fixture
+def secrets_manager(monkeypatch):
+    sm = FakeSecretsManager()
+    monkeypatch.setattr(aws, '_secrets_manager', lambda: sm)
+    monkeypatch.setattr(aws, '_secrets', {})
+    return sm
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(aws, 'time', SimpleNamespace(monotonic=lambda: now.value))
+    return now
+
+
+def test_secrets_are_cached_until_the_ttl_expires(secrets_manager, clock):
+    assert aws.get_secrets('snowflake') == {'password': 'snowflake-1'}
+    clock.value += aws.SECRETS_TTL_S - 1
+    assert aws.get_secrets('snowflake') == {'password': 'snowflake-1'}
+    assert secrets_manager.lookups == 1
+
+    clock.value += 2
+    assert aws.get_secrets('snowflake') == {'password': 'snowflake-2'}
+    assert secrets_manager.lookups == 2
+
+
+def test_invalidated_secrets_are_fetched_again(secrets_manager, clock):
+    aws.get_secrets('snowflake')
+    aws.get_secrets('telemetry')
+
+    aws.invalidate_secrets('snowflake')
+
+    assert aws.get_secrets('snowflake') == {'password': 'snowflake-3'}
+    assert aws.get_secrets('telemetry') == {'password': 'telemetry-2'}
+    assert secrets_manager.lookups == 3
+
+
+def test_invalidating_an_uncached_secret_is_a_no_op(secrets_manager):
+    aws.invalidate_secrets('snowflake')
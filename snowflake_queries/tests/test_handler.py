@@ -0,0 +1,234 @@
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+import gzip
+import json
+import os
+import runpy
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import handler
+from constants import MAX_RETRY_DELAY_S, MAX_SEND_RETRIES, TELEMETRY_SECRETS_ID, GZIP_MIN_SIZE
+from util import aws, snowflake
+
+HANDLER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'handler.py')
+
+
+class FakeResponse:
+    status_code = 200
+    ok = True
+    text = ''
+    headers = {}
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture
+def posted(monkeypatch):
+    """Stubs Snowflake, Secrets Manager and HTTP, and collects the records POSTed to the telemetry API."""
+    sent = []
+
+    @contextmanager
+    def connection(secrets_id, default_warehouse):
+        yield object()
+
+    def execute_columns(conn, sql, timeout=None, *, params=None):
+        yield {
+            'element_name': ['etl-job||customer-a', 'etl-job||customer-b'],
+            'filter': ['{"custom:Snowflake Warehouse":["etl"]}', '{"custom:Snowflake Warehouse":["etl"]}'],
+            'value': [1.5, 2.0],
+            'timestamp': [datetime(2026, 1, 1, 3), datetime(2026, 1, 1, 3)]
+        }
+
+    def post(session, url, headers=None, data=None, timeout=None):
+        if headers and headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        sent.extend(json.loads(data)['records'])
+        return FakeResponse()
+
+    monkeypatch.setattr(snowflake, 'connection', connection)
+    monkeypatch.setattr(snowflake, 'execute_columns', execute_columns)
+    monkeypatch.setattr(aws, 'get_secrets', lambda secret_id: {'external_api_key': 'key'})
+    monkeypatch.setattr(requests.Session, 'post', post)
+    return sent
+
+
+def test_script_entry_point_sends_records(posted):
+    runpy.run_path(HANDLER, run_name='__main__')
+
+    assert [x['element-name'] for x in posted] == ['etl-job||customer-a', 'etl-job||customer-b']
+    assert posted[0]['filter'] == {'custom:Snowflake Warehouse': ['etl']}
+    assert posted[0]['granularity'] == 'hourly'
+
+
+def _response(status_code, retry_after=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = b''
+    if retry_after is not None:
+        response.headers['Retry-After'] = retry_after
+    return response
+
+
+def _throttled(retry_after=None):
+    return _response(429, retry_after)
+
+
+def test_retry_delay_honors_retry_after_seconds():
+    assert 5 <= handler._retry_delay(_throttled('5'), attempt=0) < 6
+
+
+def test_retry_delay_gives_up_on_too_long_retry_after():
+    assert handler._retry_delay(_throttled(str(MAX_RETRY_DELAY_S + 1)), attempt=0) is None
+
+
+@pytest.mark.parametrize('retry_after', [None, 'Wed, 21 Oct 2015 07:28:00 GMT', 'soon', '\xb2'])
+def test_retry_delay_backs_off_without_usable_retry_after(retry_after):
+    assert 4 <= handler._retry_delay(_throttled(retry_after), attempt=2) < 5
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.posts = 0
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        self.posts += 1
+        self.headers, self.data = headers, data
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(handler, 'time', SimpleNamespace(sleep=slept.append, monotonic=lambda: 0.0))
+    return slept
+
+
+def _send(session, count=1):
+    records = [handler.TelemetryRecord(handler.UnitCostGranularity.hourly, f'etl-{i}', {}, 'stream', 1.0,
+                                       datetime(2026, 1, 1)) for i in range(count)]
+    handler._send_telemetry_records(handler.TelemetryApiConnection(url='https://telemetry', session=session),
+                                    records)
+
+
+def test_send_reposts_after_being_throttled(sleeps):
+    session = FakeSession(_throttled('2'), _response(200))
+
+    _send(session)
+
+    assert session.posts == 2
+    assert len(sleeps) == 1 and 2 <= sleeps[0] < 3
+
+
+def test_send_gives_up_on_a_retry_after_longer_than_the_cap(sleeps):
+    session = FakeSession(_throttled(str(MAX_RETRY_DELAY_S + 1)), _response(200))
+
+    with pytest.raises(requests.HTTPError):
+        _send(session)
+    assert session.posts == 1
+    assert sleeps == []
+
+
+def test_send_raises_after_the_last_retry(sleeps):
+    session = FakeSession(*[_response(503) for _ in range(MAX_SEND_RETRIES + 1)])
+
+    with pytest.raises(requests.HTTPError):
+        _send(session)
+    assert session.posts == MAX_SEND_RETRIES + 1
+    assert len(sleeps) == MAX_SEND_RETRIES
+
+
+@pytest.mark.parametrize('status_code', [401, 403])
+def test_send_drops_the_api_key_and_session_on_auth_failure(status_code, monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(aws, 'invalidate_secrets', invalidated.append)
+    session = FakeSession(_response(status_code))
+
+    with pytest.raises(requests.HTTPError):
+        _send(session)
+    assert invalidated == [TELEMETRY_SECRETS_ID]
+    assert session.closed
+
+
+def test_send_gzips_payloads_of_at_least_gzip_min_size(sleeps):
+    session = FakeSession(_response(200))
+
+    _send(session, count=50)
+
+    assert session.headers == {'Content-Encoding': 'gzip'}
+    body = gzip.decompress(session.data)
+    assert len(body) >= GZIP_MIN_SIZE
+    assert [x['element-name'] for x in json.loads(body)['records']] == [f'etl-{i}' for i in range(50)]
+
+
+def test_send_leaves_small_payloads_uncompressed(sleeps):
+    session = FakeSession(_response(200))
+
+    _send(session)
+
+    assert session.headers is None
+    assert len(session.data) < GZIP_MIN_SIZE
+    assert json.loads(session.data)['records'][0]['element-name'] == 'etl-0'
+
+
+class FailingSession:
+    def __init__(self, fail_on):
+        self.fail_on = fail_on
+        self.posts = 0
+        self.lock = threading.Lock()
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        with self.lock:
+            self.posts += 1
+            if self.posts == self.fail_on:
+                raise requests.ConnectionError('connection reset')
+        return _response(200)
+
+
+def test_failed_send_stops_collection_and_is_raised(monkeypatch):
+    rows_read = []
+
+    @contextmanager
+    def connection(secrets_id, default_warehouse):
+        yield object()
+
+    def execute_columns(conn, sql, timeout=None, *, params=None):
+        for i in range(200):
+            rows_read.append(i)
+            yield {'element_name': [f'etl-{i}'], 'filter': [''], 'value': [1.0], 'timestamp': [datetime(2026, 1, 1)]}
+
+    session = FailingSession(fail_on=3)
+    monkeypatch.setattr(snowflake, 'connection', connection)
+    monkeypatch.setattr(snowflake, 'execute_columns', execute_columns)
+    monkeypatch.setattr(handler, '_connect_api', lambda: handler.TelemetryApiConnection(url='https://telemetry',
+                                                                                        session=session))
+    monkeypatch.setattr(handler, 'MAX_RECORDS_PER_CALL', 1)
+
+    errors = []
+
+    def run():
+        try:
+            handler.send_data_from_view(handler.DateRange(datetime(2026, 1, 1), datetime(2026, 1, 1, 1)),
+                                        'stream', handler.QUERY_EXECUTION_TIME_TELEMETRY_VIEW)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+
+    assert not thread.is_alive(), 'send_data_from_view hung after a failed send'
+    assert len(errors) == 1 and isinstance(errors[0], requests.ConnectionError)
+    # The producer stops reading from Snowflake soon after the failure instead of sending everything
+    assert len(rows_read) < 200
@@ -0,0 +1,253 @@
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+import atexit
+import gc
+import logging
+import threading
+from types import SimpleNamespace
+
+import pytest
+from snowflake.connector.cursor import ResultState, SnowflakeCursorBase
+
+from util import snowflake
+from util.cursors import LowercaseDictCursor
+
+
+class FakeSnowflakeConnection:
+    """Just enough of a SnowflakeConnection for the connector's own cursor classes to fetch from."""
+    log_max_query_length = 1000
+    _reuse_results = False
+
+    def __init__(self, *results):
+        # One (description, rows) pair per query, in the order the queries are executed
+        self.results = list(results)
+        self.executed = []
+        self.rows_fetched = 0
+
+    def cursor(self, cursor_class):
+        return cursor_class(self)
+
+    def is_closed(self):
+        return False
+
+    def _rows(self, rows):
+        for row in rows:
+            self.rows_fetched += 1
+            yield row
+
+
+@pytest.fixture(autouse=True)
+def fake_query_execution(monkeypatch):
+    # Stands in for the round trip to Snowflake; fetching still goes through the connector's cursor code
+    def execute(self, command, params=None, timeout=None):
+        description, rows = self._connection.results.pop(0)
+        self._connection.executed.append((command, params, timeout))
+        self._fake_description = description
+        self._result = self._connection._rows(rows)
+        self._result_state = ResultState.VALID
+        self._rownumber = -1
+        return self
+
+    monkeypatch.setattr(SnowflakeCursorBase, 'execute', execute)
+    monkeypatch.setattr(SnowflakeCursorBase, 'description', property(lambda self: self._fake_description))
+
+
+def test_lowercase_dict_cursor_fetches_lowercase_dicts():
+    conn = FakeSnowflakeConnection(
+        ([('ELEMENT_NAME',), ('Value',)], [('a', 1), ('b', 2), ('c', 3)]),
+        ([('WAREHOUSE',)], [('etl',)])
+    )
+    curs = conn.cursor(LowercaseDictCursor)
+
+    curs.execute('SELECT 1')
+    assert curs.fetchone() == {'element_name': 'a', 'value': 1}
+    assert curs.fetchmany(1) == [{'element_name': 'b', 'value': 2}]
+    assert curs.fetchall() == [{'element_name': 'c', 'value': 3}]
+
+    curs.execute('SHOW WAREHOUSES')
+    assert curs.fetchall() == [{'warehouse': 'etl'}]
+
+
+def test_execute_returns_lowercase_rows():
+    conn = FakeSnowflakeConnection(([('ELEMENT_NAME',), ('Value',)], [('a', 1), ('b', 2)]))
+
+    rows = list(snowflake.execute(conn, 'SELECT %s', 30, params=[1]))
+
+    assert rows == [{'element_name': 'a', 'value': 1}, {'element_name': 'b', 'value': 2}]
+    assert conn.executed == [('SELECT %s', [1], 30)]
+
+
+def test_execute_fetches_batch_size_rows_at_a_time():
+    conn = FakeSnowflakeConnection(([('N',)], [(i,) for i in range(5)]))
+
+    rows = snowflake.execute(conn, 'SELECT n', batch_size=2)
+
+    assert next(rows) == {'n': 0}
+    assert conn.rows_fetched == 2
+    assert [x['n'] for x in rows] == [1, 2, 3, 4]
+    assert conn.rows_fetched == 5
+
+
+class InheritedConnection:
+    """Logs its session out when closed at exit or garbage collected, like the connector's connections."""
+    logouts = 0
+    exit_handlers = []
+
+    def __init__(self):
+        if self._close_at_exit is not None:
+            self.exit_handlers.append(self._close_at_exit)
+
+    def _close_at_exit(self):
+        self.close()
+
+    def close(self):
+        InheritedConnection.logouts += 1
+
+    def is_closed(self):
+        return False
+
+    def __del__(self):
+        self.close()
+
+
+class ConnectionWithoutExitHandler(InheritedConnection):
+    _close_at_exit = None
+
+
+@pytest.fixture
+def parent_pools(monkeypatch):
+    monkeypatch.setattr(InheritedConnection, 'logouts', 0)
+    monkeypatch.setattr(InheritedConnection, 'exit_handlers', [])
+    monkeypatch.setattr(atexit, 'unregister', InheritedConnection.exit_handlers.remove)
+    monkeypatch.setattr(snowflake, '_pools', {})
+    monkeypatch.setattr(snowflake, '_inherited_pools', [])
+
+    def make_pool(connection_class=InheritedConnection):
+        pool = snowflake.SnowflakePool(connection_class)
+        snowflake._pools[('secrets', str(len(snowflake._pools)))] = pool
+        return pool
+    return make_pool
+
+
+def test_forked_child_never_logs_out_inherited_connections(parent_pools):
+    pool = parent_pools()
+    idle = pool.acquire()
+    pool.release(idle)
+    pool.acquire()  # Still checked out at fork
+    # Only the module's pool registry is left holding the pool, as in a real forked child
+    del idle, pool
+
+    snowflake._forget_pools_after_fork()
+    gc.collect()
+
+    assert snowflake._pools == {}
+    assert InheritedConnection.exit_handlers == []
+    assert InheritedConnection.logouts == 0
+
+
+def test_forked_child_warns_without_close_at_exit(parent_pools, caplog):
+    parent_pools(ConnectionWithoutExitHandler).acquire()
+
+    with caplog.at_level(logging.WARNING, logger='snowflake-queries-telemetry'):
+        snowflake._forget_pools_after_fork()
+
+    assert '_close_at_exit' in caplog.text
+
+
+class PooledConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def is_closed(self):
+        return self.closed
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(snowflake, 'time', SimpleNamespace(monotonic=lambda: now.value))
+    return now
+
+
+def _acquire_in_thread(pool):
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(pool.acquire()), daemon=True)
+    thread.start()
+    return thread, acquired
+
+
+def test_pool_reuses_idle_connections():
+    pool = snowflake.SnowflakePool(PooledConnection)
+    conn = pool.acquire()
+    pool.release(conn)
+
+    assert pool.acquire() is conn
+
+
+def test_pool_closes_connections_idle_past_the_timeout(clock):
+    pool = snowflake.SnowflakePool(PooledConnection, idle_timeout_s=60)
+    conn = pool.acquire()
+    pool.release(conn)
+    clock.value += 61
+
+    assert pool.acquire() is not conn
+    assert conn.closed
+
+
+def test_pool_keeps_min_size_connections_past_the_timeout(clock):
+    pool = snowflake.SnowflakePool(PooledConnection, min_size=1, idle_timeout_s=60)
+    conn = pool.acquire()
+    pool.release(conn)
+    clock.value += 61
+
+    assert pool.acquire() is conn
+    assert not conn.closed
+
+
+def test_pool_discards_closed_connections():
+    pool = snowflake.SnowflakePool(PooledConnection, max_size=1)
+    conn = pool.acquire()
+    conn.close()
+    pool.release(conn)
+
+    assert pool.acquire() is not conn
+
+
+def test_pool_releases_the_slot_when_connecting_fails():
+    attempts = []
+
+    def factory():
+        attempts.append(None)
+        if len(attempts) == 1:
+            raise RuntimeError('login failed')
+        return PooledConnection()
+
+    pool = snowflake.SnowflakePool(factory, max_size=1)
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+
+    thread, acquired = _acquire_in_thread(pool)
+    thread.join(timeout=5)
+    assert len(acquired) == 1
+
+
+def test_pool_blocks_at_max_size_until_a_connection_is_released():
+    pool = snowflake.SnowflakePool(PooledConnection, max_size=1)
+    conn = pool.acquire()
+
+    thread, acquired = _acquire_in_thread(pool)
+    thread.join(timeout=0.2)
+    assert acquired == []
+
+    pool.release(conn)
+    thread.join(timeout=5)
+    assert acquired == [conn]
+
+
+@pytest.mark.parametrize('min_size, max_size', [(0, 0), (3, 2)])
+def test_pool_rejects_invalid_limits(min_size, max_size):
+    with pytest.raises(ValueError):
+        snowflake.SnowflakePool(PooledConnection, min_size=min_size, max_size=max_size)
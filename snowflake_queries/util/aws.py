@@ -1,11 +1,47 @@
 # Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
 # Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
 import json
-import boto3
+import os
+import time
+from threading import Lock
+from typing import Any, Dict, Tuple
 
-sm = boto3.client('secretsmanager')
+SECRETS_TTL_S = max(0.0, float(os.environ.get('SECRETS_TTL_SECONDS', 900)))
+
+_sm = None
+_sm_lock = Lock()
+_secrets: Dict[str, Tuple[Dict[str, Any], float]] = {}
+
+
+def _secrets_manager():
+    # boto3's default session isn't thread safe, so the shared client is created under a lock
+    global _sm
+    with _sm_lock:
+        if _sm is None:
+            import boto3
+            _sm = boto3.client('secretsmanager')
+        return _sm
+
+
+def _forget_client_after_fork():
+    global _sm, _sm_lock
+    _sm = None
+    _sm_lock = Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_client_after_fork)
 
 
 def get_secrets(secret_id):
-    secret = sm.get_secret_value(SecretId=secret_id)['SecretString']
-    return json.loads(secret)
+    # Cached for SECRETS_TTL_S so rotated credentials are picked up without recycling the process
+    cached = _secrets.get(secret_id)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    secret = json.loads(_secrets_manager().get_secret_value(SecretId=secret_id)['SecretString'])
+    _secrets[secret_id] = (secret, time.monotonic() + SECRETS_TTL_S)
+    return secret
+
+
+def invalidate_secrets(secret_id):
+    _secrets.pop(secret_id, None)
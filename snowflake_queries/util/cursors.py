@@ -0,0 +1,28 @@
+# Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
+# Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+from typing import Any, Dict, List, Optional
+
+from snowflake.connector.cursor import SnowflakeCursor
+
+
+class LowercaseDictCursor(SnowflakeCursor):
+    """
+    Returns rows as dicts keyed by lowercase column name. The lowercased names are worked out once per
+    query rather than for every row; fetchmany() and fetchall() go through fetchone().
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lowercase_columns: Optional[List[str]] = None
+
+    def execute(self, *args, **kwargs):
+        self._lowercase_columns = None
+        return super().execute(*args, **kwargs)
+
+    def fetchone(self) -> Optional[Dict[str, Any]]:
+        row = super().fetchone()
+        if row is None:
+            return None
+        if self._lowercase_columns is None:
+            self._lowercase_columns = [x[0].lower() for x in self.description]
+        return dict(zip(self._lowercase_columns, row))
@@ -5,8 +5,14 @@ from decimal import Decimal
 from enum import Enum
 from typing import Any
 from uuid import UUID
+
 import simplejson as json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class ExtendedEncoder(json.JSONEncoder):
     def __init__(self, **kwargs):
@@ -24,16 +30,58 @@ class ExtendedEncoder(json.JSONEncoder):
         return super(ExtendedEncoder, self).default(o)
 
 
-def dumps(obj, **kwargs):
+def _orjson_default(o):
+    # orjson handles datetime, UUID and Enum natively, but not their subclasses (e.g. pandas.Timestamp)
+    if isinstance(o, Decimal):
+        return str(o)
+    if isinstance(o, Enum):
+        return o.value
+    if isinstance(o, datetime):
+        return o.isoformat()
+    if isinstance(o, UUID):
+        return str(o)
+    if hasattr(o, '_asdict'):
+        return o._asdict()
+    if hasattr(o, '__iter__'):
+        return list(o)
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+def _simplejson_dumps(obj, **kwargs):
     return json.dumps(obj, **{**dict(
         cls=ExtendedEncoder,
         use_decimal=False,
-        iterable_as_array=True
+        iterable_as_array=True,
+        separators=(',', ':')
     ), **kwargs})
 
 
+# orjson is only used when no simplejson-specific options are passed.  Both backends produce the same
+# compact output, with naive datetimes left without a UTC offset, just like datetime.isoformat().  Anything
+# orjson refuses (e.g. integers wider than 64 bits) is retried with simplejson.  The one difference left is
+# that orjson writes NaN and Infinity as null, where simplejson raises ValueError.
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY if orjson is not None else 0
+
+
+def dumpb(obj, **kwargs) -> bytes:
+    if orjson is None or kwargs:
+        return _simplejson_dumps(obj, **kwargs).encode('utf-8')
+    try:
+        return orjson.dumps(obj, default=_orjson_default, option=_ORJSON_OPTIONS)
+    except orjson.JSONEncodeError:
+        return _simplejson_dumps(obj).encode('utf-8')
+
+
+def dumps(obj, **kwargs):
+    if orjson is None or kwargs:
+        return _simplejson_dumps(obj, **kwargs)
+    return dumpb(obj).decode()
+
+
 def loads(fp, **kwargs):
-    return json.loads(fp, **kwargs)
+    if orjson is None or kwargs:
+        return json.loads(fp, **kwargs)
+    return orjson.loads(fp)
 
 
 def serializable(blob: Any) -> Any:
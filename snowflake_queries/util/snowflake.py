@@ -1,33 +1,231 @@
 # Copyright (c) 2016-present, CloudZero, Inc. All rights reserved.
 # Licensed under the BSD-style license. See LICENSE file in the project root for full license information.
+import atexit
 import logging
-from typing import Mapping, Any, List, cast
-
-import snowflake
-from snowflake.connector import SnowflakeConnection
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Mapping, Any, List, Iterator, Union, Callable, Dict, Tuple, Sequence, TYPE_CHECKING
 
 from util import aws
 
+if TYPE_CHECKING:
+    from snowflake.connector import SnowflakeConnection
+
 DictRow = Mapping[str, Any]
 QueryResult = List[DictRow]
+ColumnBatch = Dict[str, List[Any]]
 
 
 logger = logging.getLogger('snowflake-queries-telemetry')
 
+DEFAULT_FETCH_SIZE = 3000
+POOL_MIN_SIZE = max(0, int(os.environ.get('SNOWFLAKE_POOL_MIN', 0)))
+POOL_MAX_SIZE = max(1, int(os.environ.get('SNOWFLAKE_POOL_MAX', 10)))
+POOL_IDLE_TIMEOUT_S = max(0.0, float(os.environ.get('SNOWFLAKE_POOL_IDLE_TIMEOUT', 300)))
+
+
+def connect(secrets_id: str, default_warehouse: str) -> 'SnowflakeConnection':
+    # Imported here since the connector pulls in pyarrow, pandas and cryptography, which is slow
+    import snowflake.connector
 
-def connect(secrets_id: str, default_warehouse: str) -> SnowflakeConnection:
     credentials = aws.get_secrets(secrets_id)
-    return snowflake.connector.connect(
-        warehouse=default_warehouse,
-        user=credentials['user'],
-        account=credentials['account'],
-        password=credentials['password'])
+    try:
+        return snowflake.connector.connect(
+            warehouse=default_warehouse,
+            user=credentials['user'],
+            account=credentials['account'],
+            password=credentials['password'],
+            client_session_keep_alive=True)
+    except snowflake.connector.DatabaseError:
+        # The password may have been rotated; fetch fresh credentials on the next attempt
+        aws.invalidate_secrets(secrets_id)
+        raise
+
+
+class SnowflakePool:
+    """
+    Keeps logged-in connections around for reuse so each query doesn't pay for a new login.
+    Connections idle for longer than idle_timeout_s are closed, unless that would leave
+    fewer than min_size open.
+    """
+
+    def __init__(self, factory: Callable[[], 'SnowflakeConnection'], min_size: int = POOL_MIN_SIZE,
+                 max_size: int = POOL_MAX_SIZE, idle_timeout_s: float = POOL_IDLE_TIMEOUT_S):
+        if max_size < 1:
+            raise ValueError(f'max_size must be at least 1, got {max_size}')
+        if min_size > max_size:
+            raise ValueError(f'min_size ({min_size}) must not be greater than max_size ({max_size})')
+        self._factory = factory
+        self._min_size = min_size
+        self._idle_timeout_s = idle_timeout_s
+        self._idle: queue.Queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._size = 0
+        # Every connection opened and not yet discarded, whether idle or checked out
+        self._connections = set()
+
+    def _discard(self, conn: 'SnowflakeConnection'):
+        with self._lock:
+            self._size -= 1
+            self._connections.discard(conn)
+        try:
+            conn.close()
+        except Exception:
+            logger.warning('Failed to close pooled Snowflake connection', exc_info=True)
+
+    def _expired(self, idle_since: float) -> bool:
+        with self._lock:
+            above_min = self._size > self._min_size
+        return above_min and time.monotonic() - idle_since > self._idle_timeout_s
+
+    def acquire(self) -> 'SnowflakeConnection':
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    conn, idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                if conn.is_closed() or self._expired(idle_since):
+                    self._discard(conn)
+                else:
+                    return conn
+
+            conn = self._factory()
+            with self._lock:
+                self._size += 1
+                self._connections.add(conn)
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn: 'SnowflakeConnection'):
+        try:
+            if conn.is_closed():
+                self._discard(conn)
+            else:
+                self._idle.put((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator['SnowflakeConnection']:
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    def _detach_after_fork(self):
+        # The connector registers an atexit handler per connection that logs it out; in a forked child that
+        # would end the parent's sessions.  No locks here, they may have been held by another thread at fork.
+        for conn in list(self._connections):
+            close_at_exit = getattr(conn, '_close_at_exit', None)
+            if close_at_exit is not None:
+                atexit.unregister(close_at_exit)
+            else:
+                logger.warning('Snowflake connection has no _close_at_exit; an inherited session may be '
+                               'logged out when this process exits')
+
+
+_pools: Dict[Tuple[str, str], SnowflakePool] = {}
+_pools_lock = threading.Lock()
+# Pools inherited from the parent process.  They stay referenced for the life of a forked child so their
+# connections are never garbage collected, which would close (log out) the parent's sessions.
+_inherited_pools: List[SnowflakePool] = []
+
+
+def get_pool(secrets_id: str, default_warehouse: str) -> SnowflakePool:
+    key = (secrets_id, default_warehouse)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = SnowflakePool(lambda: connect(secrets_id, default_warehouse))
+        return _pools[key]
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+
+
+def _forget_pools_after_fork():
+    # The child shares the parent's sockets and sessions, so drop the pools without closing (logging out) anything
+    global _pools, _pools_lock
+    for pool in list(_pools.values()):
+        pool._detach_after_fork()
+        _inherited_pools.append(pool)
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_pools_after_fork)
+
+
+@contextmanager
+def connection(secrets_id: str, default_warehouse: str) -> Iterator['SnowflakeConnection']:
+    with get_pool(secrets_id, default_warehouse).connection() as conn:
+        yield conn
+
+
+def _stream_columns(conn: 'SnowflakeConnection', sql: str, params: Sequence[Any] = None,
+                    timeout: int = None) -> Iterator[ColumnBatch]:
+    # Yields one set of columns per Arrow result chunk so only a single chunk is resident at a time.
+    # Timestamps are fetched at microsecond precision so they convert to datetime rather than pandas.Timestamp.
+    with conn.cursor() as curs:
+        curs.execute(sql, params, timeout=timeout)
+        columns = [x[0].lower() for x in curs.description]
+        for batch in curs.fetch_arrow_batches(force_microsecond_precision=True):
+            yield {name: batch.column(i).to_pylist() for i, name in enumerate(columns)}
+
+
+def _stream_batches(conn: 'SnowflakeConnection', sql: str, params: Sequence[Any] = None,
+                    timeout: int = None) -> Iterator[QueryResult]:
+    for batch in _stream_columns(conn, sql, params, timeout=timeout):
+        yield [dict(zip(batch.keys(), x)) for x in zip(*batch.values())]
+
+
+def _fetch_rows(conn: 'SnowflakeConnection', sql: str, params: Sequence[Any] = None, timeout: int = None,
+                batch_size: int = DEFAULT_FETCH_SIZE) -> Iterator[DictRow]:
+    from util.cursors import LowercaseDictCursor
+
+    # fetchmany() keeps at most batch_size rows in flight instead of materializing the whole result
+    with conn.cursor(LowercaseDictCursor) as curs:
+        curs.execute(sql, params, timeout=timeout)
+        curs.arraysize = batch_size
+        while True:
+            rows = curs.fetchmany()
+            if not rows:
+                break
+            yield from rows
+
+
+def execute(conn: 'SnowflakeConnection', sql: str, timeout: int = None, *, params: Sequence[Any] = None,
+            stream: bool = False,
+            batch_size: int = DEFAULT_FETCH_SIZE) -> Union[Iterator[DictRow], Iterator[QueryResult]]:
+    logger.debug(f"Execute Query: [{sql}] Params: {params}")
 
+    if stream:
+        return _stream_batches(conn, sql, params, timeout=timeout)
+    return _fetch_rows(conn, sql, params, timeout=timeout, batch_size=batch_size)
 
-def execute(conn: SnowflakeConnection, sql: str, timeout: int = None) -> QueryResult:
-    logger.debug(f"Execute Query: [{sql}]")
 
-    with conn.cursor(snowflake.connector.DictCursor) as curs:
-        curs.execute(sql, timeout=timeout)
-        result = cast(List[dict], curs.fetchall())
-        return [{k.lower(): v for k, v in x.items()} for x in result]
+def execute_columns(conn: 'SnowflakeConnection', sql: str, timeout: int = None, *,
+                    params: Sequence[Any] = None) -> Iterator[ColumnBatch]:
+    logger.debug(f"Execute Query: [{sql}] Params: {params}")
+    return _stream_columns(conn, sql, params, timeout=timeout)